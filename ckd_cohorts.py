@@ -0,0 +1,235 @@
+import pandas as pd
+import numpy as np
+import sys
+import argparse
+import utilities as util
+import member_dim
+
+# member predicates available as cohort filters
+COHORTS = {
+    "adults": lambda dim: dim.attributes["age"] >= 18,
+    "jvhl_denom": lambda dim: dim.attributes["jvhl_denom_flag"] == 1,
+    "medical_nondual": lambda dim: dim.attributes["n_month_medical_nondual"] > 0,
+    "dual": lambda dim: dim.attributes["n_month_dual"] > 0,
+    "esrd": lambda dim: dim.attributes["esrd_flag"] == 1,
+    "ckd_ccw": lambda dim: dim.attributes["ckd_ccw_flag"] == 1,
+    "ckd_no_esrd": lambda dim: dim.attributes["ckd_no_esrd_flag"] == 1,
+}
+
+# cohorts of members with any such enrolled month; saved costs cover all their enrolled
+# months, unlike clm_sum for these groups, which only costs the matching months
+WHOLE_YEAR_COST_COHORTS = ["medical_nondual", "dual"]
+
+
+def popcount(bits):
+    """
+    Counts the set bits of a packed bitmap
+    Returns an integer
+    """
+    if hasattr(np, "bitwise_count"):
+        return int(np.bitwise_count(bits).sum(dtype=np.int64))
+    return int(np.unpackbits(bits).sum(dtype=np.int64))
+
+
+class CohortEngine:
+    """
+    Holds each cohort predicate and each stage category of a year's members as a packed
+        bitmap, so cohort by stage frequencies are a bitmap AND plus a popcount
+    """
+
+    def __init__(self, dim):
+        self.dim = dim
+        self.predicates = {}
+        self.stages = {}
+
+    def predicate(self, name):
+        if name not in self.predicates:
+            self.predicates[name] = np.packbits(COHORTS[name](self.dim))
+        return self.predicates[name]
+
+    def stage(self, var):
+        if var not in self.stages:
+            codes = np.asarray(self.dim.stages[var])
+            self.stages[var] = [
+                np.packbits(codes == k) for k in range(len(self.dim.categories[var]))
+            ]
+        return self.stages[var]
+
+    def cohort(self, names):
+        """
+        Combines cohort predicates
+        Returns a packed bitmap of members meeting all of them
+        """
+        bits = np.packbits(np.ones(len(self.dim), dtype=bool))
+        for name in names:
+            bits = bits & self.predicate(name)
+        return bits
+
+    def mask(self, bits):
+        """
+        Expands a packed bitmap to one boolean per member
+        Returns a boolean array
+        """
+        return np.unpackbits(bits, count=len(self.dim)).view(bool)
+
+    def freq(self, var, names=()):
+        """
+        Gets a frequency of a stage variable within a cohort
+        Returns a dataframe in the same layout as freq_query
+        """
+        bits = self.cohort(names)
+        return pd.DataFrame(
+            {
+                var: self.dim.categories[var],
+                "n": [popcount(bits & stage) for stage in self.stage(var)],
+            }
+        )
+
+    def crosstab(self, var, var2, names=()):
+        """
+        Gets a crosstab of two stage variables within a cohort
+        Returns a dataframe of nonzero cells
+        """
+        bits = self.cohort(names)
+        rows = []
+        for label, stage in zip(self.dim.categories[var], self.stage(var)):
+            in_stage = bits & stage
+            for label2, stage2 in zip(self.dim.categories[var2], self.stage(var2)):
+                n = popcount(in_stage & stage2)
+                if n > 0:
+                    rows.append({var: label, var2: label2, "n": n})
+        return pd.DataFrame(rows, columns=[var, var2, "n"])
+
+    def cost(self, var, names=()):
+        """
+        Sums costs by stage within a cohort as masked reductions over member arrays
+        Returns a dataframe in the same layout as clm_sum
+        """
+        # clm_sum only costs claims stages for members with CKD and no ESRD
+        if var == "ckd_stage_claims":
+            names = list(names) + ["ckd_no_esrd"]
+        bits = self.cohort(names)
+        cost_sum = np.nan_to_num(np.asarray(self.dim.attributes["cost_sum"], dtype=float))
+        n_year = np.nan_to_num(np.asarray(self.dim.attributes["n_year"], dtype=float))
+        rows = []
+        for label, stage in zip(self.dim.categories[var], self.stage(var)):
+            members = self.mask(bits & stage)
+            total_cost = cost_sum[members].sum()
+            years = n_year[members].sum()
+            rows.append(
+                {
+                    "stage_var": var,
+                    "stage": label,
+                    "total_cost": total_cost,
+                    "n_year": years,
+                    "cost_per_bene_yr": total_cost / years if years > 0 else np.nan,
+                }
+            )
+        return pd.DataFrame(rows)
+
+
+def process_arguments(args):
+    """
+    Processes command line arguments provided to ckd_cohorts.py
+    Returns a dictionary of arguments
+    """
+    parser = argparse.ArgumentParser(
+        description="Stage frequencies and costs for cohorts of saved member-level results"
+    )
+    parser.add_argument(
+        "-yr",
+        "--year",
+        dest="year",
+        required=True,
+        action="store",
+        help="Year with saved results (formatted yyyy)",
+    )
+    parser.add_argument(
+        "-c",
+        "--cohort",
+        dest="cohorts",
+        nargs="*",
+        choices=list(COHORTS),
+        default=["adults"],
+        help="Cohort filters to combine (all must hold)",
+    )
+    parser.add_argument(
+        "-v",
+        "--vars",
+        dest="stage_vars",
+        nargs="+",
+        choices=member_dim.STAGE_VARS,
+        default=member_dim.STAGE_VARS,
+        help="Stage variables to tabulate",
+    )
+    parser.add_argument(
+        "-b",
+        "--by",
+        dest="by_var",
+        action="store",
+        choices=member_dim.STAGE_VARS,
+        default="",
+        help="Stage variable to crosstab each tabulated variable against",
+    )
+    parser.add_argument(
+        "-t",
+        "--test",
+        dest="test_run",
+        action="store_true",
+        help="Include this argument to use results saved from a test run",
+    )
+    parser.add_argument(
+        "-o",
+        "--output",
+        dest="output_path",
+        action="store",
+        default="",
+        help="Path of the output file (defaults to the output folder)",
+    )
+
+    try:
+        assert len(args) > 0
+    except:
+        parser.print_help()
+        sys.exit(2)
+
+    inputs = vars(parser.parse_args(args))
+    inputs["test_name"] = np.where(inputs["test_run"], "test_", "")
+    return inputs
+
+
+def main():
+    input_args = process_arguments(sys.argv[1:])
+    year = input_args["year"]
+    cohorts = input_args["cohorts"]
+    cond = " and ".join(cohorts) if len(cohorts) > 0 else "all members"
+    output_path = input_args["output_path"]
+    if output_path == "":
+        output_path = f"output/{input_args['test_name']}ckd_cohorts_{year}_{'_'.join(cohorts)}.txt"
+
+    if any(name in WHOLE_YEAR_COST_COHORTS for name in cohorts):
+        cost_title = f"Cost per bene year (all enrolled months) by stage for {cond} in {year}"
+    else:
+        cost_title = f"Cost per bene year by stage for {cond} in {year}"
+
+    dim = member_dim.load(year, input_args["test_name"])
+    costs = member_dim.has_costs(dim)
+    if not costs:
+        print(f"Costs were not saved for {year} (run with -d and -s); reporting counts only")
+
+    engine = CohortEngine(dim)
+    with open(output_path, "w") as f:
+        for var in input_args["stage_vars"]:
+            util.write_out_table(engine.freq(var, cohorts), f"{var} for {cond} in {year}", f)
+            if input_args["by_var"] != "":
+                util.write_out_table(
+                    engine.crosstab(var, input_args["by_var"], cohorts),
+                    f"{var} and {input_args['by_var']} crosstab for {cond} in {year}",
+                    f,
+                )
+            if costs:
+                util.write_out_table(engine.cost(var, cohorts), cost_title, f)
+
+
+if __name__ == "__main__":
+    main()
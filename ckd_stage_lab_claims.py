@@ -1,10 +1,36 @@
 import pandas as pd
 import numpy as np
 import sys
+import os
 from datetime import date
 import re
 import argparse
 import utilities as util
+import source_cache
+import local_engine
+import validation
+import instrumentation
+import member_dim
+from query_builder import Query
+
+
+# categories each combined stage variable is expected to take; anything else is reported
+STAGE_CATEGORIES = {
+    "ckd_stage_comb_all": [
+        "ESRD", "CKD, stage unknown", "stage 5", "stage 4", "stage 3b", "stage 3a",
+        "stage 2", "stage 1", "CKD, stage 3 unspecified",
+        "No lab or claim for CKD, not in JVHL denom",
+        "No lab or claim for CKD, in JVHL denom",
+    ],
+    "ckd_stage_comb_5andesrd": [
+        "stage 5/ESRD", "CKD, stage unknown/unspecified", "stage 4", "stage 3b",
+        "stage 3a", "stage 2", "stage 1", "No lab or claim for CKD",
+    ],
+    "ckd_stage_comb_w3unsp": [
+        "stage 5/ESRD", "CKD, stage unknown", "stage 4", "stage 3b", "stage 3a",
+        "stage 2", "stage 1", "stage 3 unspecified", "No lab or claim for CKD",
+    ],
+}
 
 
 def process_arguments(args):
@@ -37,6 +63,37 @@ def process_arguments(args):
         action="store_true",
         help="Include this argument to run diagnostic checks and adhoc investigations",
     )
+    parser.add_argument(
+        "-o",
+        "--output",
+        dest="output_path",
+        action="store",
+        default="",
+        help="Path of the output file (defaults to a dated file in the output folder)",
+    )
+    parser.add_argument(
+        "-e",
+        "--engine",
+        dest="engine",
+        action="store",
+        choices=["warehouse", "local"],
+        default="warehouse",
+        help="Where lab and claims staging runs; local reads the cached source extracts",
+    )
+    parser.add_argument(
+        "-s",
+        "--save",
+        dest="save_results",
+        action="store_true",
+        help="Include this argument to save member-level results for year-over-year comparisons",
+    )
+    parser.add_argument(
+        "-p",
+        "--profile",
+        dest="profile",
+        action="store_true",
+        help="Include this argument to write a memory and CPU report for each step",
+    )
 
     try:
         assert len(args) > 0
@@ -72,45 +129,45 @@ def testing_obs(test_run):
     return np.where(test_run, "top 10000", ""), np.where(test_run, "test_", "")
 
 
+def output_path(input_args):
+    """
+    Defines the output file path for a run
+    Returns a string
+    """
+    if input_args["output_path"] != "":
+        return input_args["output_path"]
+    output_date = np.where(input_args["test_run"], "", "_{}".format(str(date.today())))
+    return f"output/{input_args['test_name']}ckd_lab_claims_diagnostics_{input_args['year']}{output_date}.txt"
+
+
+@instrumentation.instrument
 def cond_flags(input_args, prev_year, cs, ctx, f):
     """
     Assigns values based on whether the test run argument is present
     Returns nothing (but creates a temporary member-level table with necessary flags)
     """
-    cs.execute(
-        f"""
-        create or replace temp table jvhl as
-            select member_id
-                  ,requestcpt
-                  ,case when numericresult = 'NULL' then null 
-                        else to_number(numericresult) end as numericresult
-                  ,textresult
-                  ,case when rlike(textresult, '>/?=? ?(60|90|120).?0?0?') 
-                            then to_number(replace(replace(replace(textresult,'/',''),'=',''),'>',''))
-                        when numericresult != 'NULL' then to_number(numericresult)
-                        else null end as all_results
-                  ,DATE_SERVICEBEGIN
-            from nkfm_prod.jvhl.labresults
-            where year(DATE_SERVICEBEGIN) in ({input_args['year']}, {prev_year})
-    """
-    )
-    print(
-        util.freq_query("numericresult,all_results", "jvhl", ctx, where="requestcpt='33914-3'")
-    )
-    print(
-        util.freq_query("textresult,all_results", "jvhl", ctx, where="requestcpt='33914-3'")
-    )
-    cs.execute(
-        f"""
-        create or replace temp table jvhl_flags as
-            select member_id
-                  ,case when datediff(day, min(DATE_SERVICEBEGIN), max(DATE_SERVICEBEGIN)) >= 90 then 1
-                        else 0 end as ckd_jvhl_flag_2labs
-            from jvhl
-            where requestcpt = '33914-3' and numericresult < 60
-            group by member_id
-    """
-    )
+    if input_args["engine"] == "local":
+        jvhl = source_cache.load_extract("labs", [prev_year, input_args["year"]])
+        print(local_engine.freq(jvhl, ["numericresult", "all_results"]))
+        print(local_engine.freq(jvhl, ["textresult", "all_results"]))
+        util.upload_dataframe("jvhl_flags", local_engine.lab_flags(jvhl), ctx)
+    else:
+        util.create_temp_table(
+            "jvhl", source_cache.lab_query([input_args["year"], prev_year]), cs
+        )
+        print(util.freq_query("numericresult,all_results", "jvhl", ctx))
+        print(util.freq_query("textresult,all_results", "jvhl", ctx))
+        cs.execute(
+            f"""
+            create or replace temp table jvhl_flags as
+                select member_id
+                      ,case when datediff(day, min(DATE_SERVICEBEGIN), max(DATE_SERVICEBEGIN)) >= 90 then 1
+                            else 0 end as ckd_jvhl_flag_2labs
+                from jvhl
+                where numericresult < 60
+                group by member_id
+        """
+        )
     cs.execute(
         f"""
         create or replace temp table member_jvhl as
@@ -150,17 +207,33 @@ def cond_flags(input_args, prev_year, cs, ctx, f):
     )
     print(util.freq_query("ckd_jvhl_flag,ckd_no_esrd_jvhl_flag", "member_jvhl", ctx))
     print(util.freq_query("ckd_jvhl_flag,ckd_jvhl_flag_2labs", "member_jvhl", ctx))
-    ckd_esrd = util.count_total(
-        "member_jvhl", ctx, where="ckd_jvhl_flag=1"
-    ) - util.count_total("member_jvhl", ctx, where="ckd_no_esrd_jvhl_flag=1")
+    profile = validation.profile_table(
+        "member_jvhl",
+        ctx,
+        unique=["member_id"],
+        counts={
+            "ckd_jvhl": "ckd_jvhl_flag = 1",
+            "ckd_no_esrd_jvhl": "ckd_no_esrd_jvhl_flag = 1",
+        },
+    )
+    validation.check_profile(input_args["checks"], "member_jvhl", profile, unique=["member_id"])
+    input_args["n_members"] = profile["n_rows"]
+    ckd_esrd = profile["ckd_jvhl"] - profile["ckd_no_esrd_jvhl"]
     f.write(f"Beneficiaries flagged as CKD from JVHL data and ESRD: {ckd_esrd}\n\n")
 
 
-def ckd_stage_lab(cs, ctx):
+@instrumentation.instrument
+def ckd_stage_lab(input_args, prev_year, cs, ctx):
     """
     Assigns CKD stage to members based on most recent (or highest) lab result
     Returns nothing (but creates a temporary member-level table with lab CKD flags)
     """
+    if input_args["engine"] == "local":
+        jvhl = source_cache.load_extract("labs", [prev_year, input_args["year"]])
+        jvhl_maxdate_result = local_engine.lab_stage(jvhl)
+        util.upload_dataframe("jvhl_maxdate_result", jvhl_maxdate_result, ctx)
+        print(local_engine.freq(jvhl_maxdate_result, ["n_labs"]))
+        return
     # max date result from JVHL
     cs.execute(
         """
@@ -168,7 +241,7 @@ def ckd_stage_lab(cs, ctx):
             select member_id
                   ,max(DATE_SERVICEBEGIN) as max_date
             from jvhl
-            where requestcpt = '33914-3' and all_results is not null
+            where all_results is not null
             group by member_id
     """
     )
@@ -184,36 +257,46 @@ def ckd_stage_lab(cs, ctx):
                 inner join jvhl_date as b
                     on a.member_id = b.member_id
                     and a.DATE_SERVICEBEGIN = b.max_date
-                    and a.requestcpt = '33914-3'
             group by a.member_id, a.DATE_SERVICEBEGIN
     """
     )
     print(util.freq_query("n_labs", "jvhl_maxdate_result", ctx))
 
 
+@instrumentation.instrument
 def ckd_stage_claims(input_args, prev_year, cs, ctx):
     """
     Assigns CKD stage to members based on most recent (or highest) claims result
     Returns nothing (but creates a temporary member-level table with lab claims flags)
     """
+    if input_args["engine"] == "local":
+        dx_date = source_cache.load_extract("dx", [prev_year, input_args["year"]])
+        dx_maxdate_result, dx_date_result = local_engine.claims_stage(dx_date)
+        util.upload_dataframe("dx_date_result", dx_date_result, ctx)
+        validation.check(
+            input_args["checks"], "dx_date_result", "row count matches dx_maxdate_result",
+            len(dx_date_result), len(dx_maxdate_result),
+        )
+        validation.check(
+            input_args["checks"], "dx_date_result", "member_id is unique",
+            dx_date_result["member_id"].nunique(), len(dx_date_result),
+        )
+        return
     # max date result from claims
-    cs.execute(
-        f"""
-        create or replace temp table dx_date as
-            select a.*
-                ,b.from_date
-                ,case when len(a.dx_code) = 4 then to_number(concat(right(a.dx_code,3),'0'))
-                    when len(a.dx_code) = 5 then to_number(right(a.dx_code,4))
-                    else null end as dx_num
-                from (
-                select * from math_prod.common.claims_dx_long_{input_args['year']} 
-                    union
-                select * from math_prod.common.claims_dx_long_{prev_year}
-                ) as a
-                left join nkfm_prod.mdhhs.nkfm_claims as b
-                    on a.claim_id = b.claim_id
-                where a.dx_code in ('N181','N182','N183','N1830','N1831','N1832','N184','N185')
-    """
+    dx_long = Query(f"math_prod.common.claims_dx_long_{input_args['year']}")
+    dx_long.select("member_id", "claim_id", "dx_code")
+    dx_long.where_in("dx_code", source_cache.CKD_DX_CODES)
+    dx_long_prev = Query(f"math_prod.common.claims_dx_long_{prev_year}")
+    dx_long_prev.select("member_id", "claim_id", "dx_code")
+    dx_long_prev.where_in("dx_code", source_cache.CKD_DX_CODES)
+    # stages only use max() per member, so duplicate rows across years need no dedup
+    dx_long.union_all(dx_long_prev)
+    util.create_temp_table(
+        "dx_date",
+        Query(dx_long, "a")
+        .select("a.member_id", "a.claim_id", "a.dx_code", "b.from_date", source_cache.DX_NUM)
+        .join("nkfm_prod.mdhhs.nkfm_claims", "b", "a.claim_id = b.claim_id"),
+        cs,
     )
     cs.execute(
         """
@@ -294,22 +377,28 @@ def ckd_stage_claims(input_args, prev_year, cs, ctx):
         """
         create or replace temp table dx_date_result as
             select * from stage3_all
-            union
+            union all
             select * from dx_maxdate_result where dx_num != 1830
     """
     )
-    assert util.count_total("dx_maxdate_result", ctx) == util.count_total(
-        "dx_date_result", ctx
+    profile = validation.profile_table(
+        "dx_date_result", ctx, unique=["member_id"], row_counts=["dx_maxdate_result"]
     )
+    validation.check(
+        input_args["checks"], "dx_date_result", "row count matches dx_maxdate_result",
+        profile["n_rows"], profile["n_rows_dx_maxdate_result"],
+    )
+    validation.check_profile(input_args["checks"], "dx_date_result", profile, unique=["member_id"])
 
 
+@instrumentation.instrument
 def stage_flags(input_args, prev_year, cs, ctx, f):
     """
     Assigns single CKD stage to members based on most recent (or highest)
         CKD stage from labs and claims
     Returns nothing (but creates a temporary member-level table with final CKD flags)
     """
-    ckd_stage_lab(cs, ctx)
+    ckd_stage_lab(input_args, prev_year, cs, ctx)
     ckd_stage_claims(input_args, prev_year, cs, ctx)
 
     # define stages
@@ -476,16 +565,36 @@ def stage_flags(input_args, prev_year, cs, ctx, f):
         util.freq_query("ckd_stage_comb_all,ckd_stage_comb_w3unsp", "final_flags", ctx)
     )
 
+    # final_flags left joins member-level tables onto member_jvhl, so an unchanged row
+    # count also means member_id is still unique
+    validation.check(
+        input_args["checks"], "final_flags", "row count matches member_jvhl",
+        validation.table_row_count("final_flags", ctx), input_args["n_members"],
+    )
+
     df1 = util.freq_query("ckd_stage_comb_all", "final_flags", ctx)
+    validation.check_coverage(
+        input_args["checks"], "final_flags", "ckd_stage_comb_all", df1,
+        STAGE_CATEGORIES["ckd_stage_comb_all"],
+    )
     util.write_out_table(df1, f"ckd_stage_comb_all for {input_args['year']}", f)
     df2 = util.freq_query("ckd_stage_comb_5andesrd", "final_flags", ctx)
+    validation.check_coverage(
+        input_args["checks"], "final_flags", "ckd_stage_comb_5andesrd", df2,
+        STAGE_CATEGORIES["ckd_stage_comb_5andesrd"],
+    )
     util.write_out_table(df2, f"ckd_stage_comb_5andesrd for {input_args['year']}", f)
     df3 = util.freq_query("ckd_stage_comb_w3unsp", "final_flags", ctx)
+    validation.check_coverage(
+        input_args["checks"], "final_flags", "ckd_stage_comb_w3unsp", df3,
+        STAGE_CATEGORIES["ckd_stage_comb_w3unsp"],
+    )
     util.write_out_table(df3, f"ckd_stage_comb_w3unsp for {input_args['year']}", f)
     df4 = util.freq_query("ckd_stage_comb_5cat", "final_flags", ctx)
     util.write_out_table(df4, f"ckd_stage_comb_5cat for {input_args['year']}", f)
 
 
+@instrumentation.instrument
 def diagnostics(input_args, prev_year, cs, ctx, f):
     """
     Outputs frequencies and averages costs by CKD stages
@@ -493,9 +602,10 @@ def diagnostics(input_args, prev_year, cs, ctx, f):
     """
     # frequencies and crosstabs
     for cond in ["adults", "adults in JVHL denominator"]:
-        where_statement = np.where(
-            cond == "adults", "age >= 18", "age >= 18 and jvhl_denom_flag = 1"
-        )
+        if cond == "adults":
+            where_statement, where_params = "age >= ?", (18,)
+        else:
+            where_statement, where_params = "age >= ? and jvhl_denom_flag = ?", (18, 1)
         for var in [
             "ckd_jvhl_flag",
             "ckd_stage_jvhl",
@@ -507,24 +617,24 @@ def diagnostics(input_args, prev_year, cs, ctx, f):
             "ckd_stage_comb_w3unsp",
             "ckd_stage_comb_5cat",
         ]:
-            df = util.freq_query(var, "final_flags", ctx, where=where_statement)
+            df = util.freq_query(var, "final_flags", ctx, where=where_statement, params=where_params)
             util.write_out_table(df, f"{var} for {cond} in {input_args['year']}", f)
             if var == "ckd_jvhl_flag":
                 for var2 in ["ckd_ccw_flag", "ckd_jvhl_flag_2labs", 
                              f"aki_flag_{input_args['year']}, aki_flag_{prev_year}"]:
                     df = util.freq_query(
-                        f"{var},{var2}", "final_flags", ctx, where=where_statement
+                        f"{var},{var2}", "final_flags", ctx, where=where_statement, params=where_params
                     )
                     util.write_out_table(df,f"{var} and {var2} crosstab for {cond} in {input_args['year']}",f)
             elif var == "ckd_stage_jvhl_detailed":
                 for var2 in ["ckd_stage_claims", "ckd_stage_claims,ckd_stage_comb_all"]:
-                    df = util.freq_query(f"{var},{var2}", "final_flags", ctx, where=where_statement)
+                    df = util.freq_query(f"{var},{var2}", "final_flags", ctx, where=where_statement, params=where_params)
                     util.write_out_table(
                         df, f"{var} and {var2} crosstab for {cond} in {input_args['year']}", f
                     )
             elif var == "ckd_stage_claims":
                 for var2 in ["esrd_flag,ckd_ccw_flag"]:
-                    df = util.freq_query(f"{var},{var2}", "final_flags", ctx, where=where_statement)
+                    df = util.freq_query(f"{var},{var2}", "final_flags", ctx, where=where_statement, params=where_params)
                     util.write_out_table(
                         df, f"{var} and {var2} crosstab for {cond} in {input_args['year']}", f
                     )
@@ -543,7 +653,9 @@ def diagnostics(input_args, prev_year, cs, ctx, f):
     )
     df_clm.rename(columns={"N": "ckd_stage_claims_date"}, inplace=True)
     df_jvhl.rename(columns={"N": "ckd_jvhl_claims_date"}, inplace=True)
-    df = pd.merge(df_clm, df_jvhl, how="outer", on="MONTH")
+    with instrumentation.step("monthly_counts_merge") as step:
+        df = pd.merge(df_clm, df_jvhl, how="outer", on="MONTH")
+        step.record(df)
     util.write_out_table(
         df, f"Monthly counts of claims and labs in {input_args['year']}", f
     )
@@ -572,6 +684,13 @@ def diagnostics(input_args, prev_year, cs, ctx, f):
     title = "Cost per bene year by stage"
     df = clm_sum(input_args["year"], cs, ctx)
     util.write_out_table(df, f"{title} for {input_args['year']}", f)
+    # keep member-level costs for all claim types before cost_sum is replaced
+    cs.execute(
+        """
+        create or replace temp table member_cost as
+            select member_id, cost_sum, n_year from cost_sum
+    """
+    )
     for cat in ["inpatient", "clinic", "op facility", "nf", "other"]:
         df = clm_sum(input_args["year"], cs, ctx, fasc_cat=cat)
         util.write_out_table(df, f"{title} for {cat} FASC category for {input_args['year']}", f)
@@ -581,104 +700,190 @@ def diagnostics(input_args, prev_year, cs, ctx, f):
     util.write_out_table(df, f"{title} where dual_flag='Y' for {input_args['year']}", f)
 
 
-def flag_where(value):
+def flag_values(value):
     """
-    Sets value for medical and dual flags using "both" option
-    Returns string
+    Sets values for medical and dual flags using "both" option
+    Returns list
     """
     if value == "both":
-        return "in ('Y','N')"
+        return ["Y", "N"]
     else:
-        return f"= '{value}'"
+        return [value]
 
 
+@instrumentation.instrument
 def clm_sum(year, cs, ctx, fasc_cat="all", med_flag="both", dual_flag="both"):
     """
     Calculates average cost by stage for specified group of people or claims
     Returns dataframe
     """
-    fasc_where = np.where(fasc_cat == "all", "!= 'drug'", f"= '{fasc_cat}'")
-    cs.execute(
-        f"""
-    create or replace temp table cost_sum as
-            select e.member_id
-                  ,max(f.ckd_stage_jvhl_detailed) as ckd_stage_jvhl_detailed
-                  ,max(f.ckd_stage_claims) as ckd_stage_claims
-                  ,max(f.ckd_stage_comb_all) as ckd_stage_comb_all
-                  ,max(f.ckd_stage_comb_5andesrd) as ckd_stage_comb_5andesrd
-                  ,max(f.ckd_no_esrd_flag) as ckd_no_esrd_flag
-                  ,max(f.ckd_stage_comb_w3unsp) as ckd_stage_comb_w3unsp
-                  ,max(f.ckd_stage_comb_5cat) as ckd_stage_comb_5cat
-                  ,sum(c.allowed_amt) as cost_sum
-                  ,max(e.n_month) / 12 as n_year
-            from (
-                    select e.member_id
-                          ,to_varchar(e.begin_date, 'yyyyMM') as month
-                          ,count(*) over (partition by e.member_id) as n_month
-                    from math_prod.common.enroll_{year} as e
-                        left join math_prod.common.member_{year} as m
-                            on e.member_id = m.member_id
-                    where e.medical_flag {flag_where(med_flag)} 
-                        and e.dual_flag {flag_where(dual_flag)} 
-                        and m.age >= 18
-                    ) as e 
-            left join (
-                    select allowed_amt, member_id, from_date
-                    from claim_prep
-                    where lower(fasc_cat_adj) {fasc_where}
-                    ) as c
-                on c.member_id = e.member_id
-                and to_varchar(c.from_date, 'yyyyMM') = e.month
-            left join final_flags as f
-                on e.member_id = f.member_id
-            group by e.member_id
-    """
+    enrolled = (
+        Query(f"math_prod.common.enroll_{year}", "e")
+        .select(
+            "e.member_id",
+            "to_varchar(e.begin_date, 'yyyyMM') as month",
+            "count(*) over (partition by e.member_id) as n_month",
+        )
+        .join(f"math_prod.common.member_{year}", "m", "e.member_id = m.member_id")
+        .where_in("e.medical_flag", flag_values(med_flag))
+        .where_in("e.dual_flag", flag_values(dual_flag))
+        .where("m.age >= ?", 18)
+    )
+    claims = Query("claim_prep").select("allowed_amt", "member_id", "from_date")
+    if fasc_cat == "all":
+        claims.where("lower(fasc_cat_adj) != ?", "drug")
+    else:
+        claims.where("lower(fasc_cat_adj) = ?", fasc_cat)
+    util.create_temp_table(
+        "cost_sum",
+        Query(enrolled, "e")
+        .select(
+            "e.member_id",
+            "max(f.ckd_stage_jvhl_detailed) as ckd_stage_jvhl_detailed",
+            "max(f.ckd_stage_claims) as ckd_stage_claims",
+            "max(f.ckd_stage_comb_all) as ckd_stage_comb_all",
+            "max(f.ckd_stage_comb_5andesrd) as ckd_stage_comb_5andesrd",
+            "max(f.ckd_no_esrd_flag) as ckd_no_esrd_flag",
+            "max(f.ckd_stage_comb_w3unsp) as ckd_stage_comb_w3unsp",
+            "max(f.ckd_stage_comb_5cat) as ckd_stage_comb_5cat",
+            "sum(c.allowed_amt) as cost_sum",
+            "max(e.n_month) / 12 as n_year",
+        )
+        .join(
+            claims,
+            "c",
+            "c.member_id = e.member_id and to_varchar(c.from_date, 'yyyyMM') = e.month",
+        )
+        .join("final_flags", "f", "e.member_id = f.member_id")
+        .group_by("e.member_id"),
+        cs,
     )
     df_all = pd.DataFrame()
     for var in ["ckd_stage_jvhl_detailed", "ckd_stage_claims", "ckd_stage_comb_all",
                 "ckd_stage_comb_5andesrd", "ckd_stage_comb_w3unsp", "ckd_stage_comb_5cat"]:
-        where_statement = np.where(var != "ckd_stage_claims", 
-                                   "", 
-                                   "where ckd_no_esrd_flag = 1")
-        df = pd.read_sql(
-            f"""
-            select '{var}' as stage_var
-                   ,{var} as stage
-                   ,sum(cost_sum) as total_cost
-                   ,sum(n_year) as n_year
-                   ,sum(cost_sum) / sum(n_year) as cost_per_bene_yr
-            from cost_sum
-            {where_statement}
-            group by {var}
-            order by {var}
-        """,
-            con=ctx,
+        query = (
+            Query("cost_sum")
+            .select(
+                f"'{var}' as stage_var",
+                f"{var} as stage",
+                "sum(cost_sum) as total_cost",
+                "sum(n_year) as n_year",
+                "sum(cost_sum) / sum(n_year) as cost_per_bene_yr",
+            )
+            .group_by(var)
+            .order_by(var)
         )
-        df_all = pd.concat([df_all, df])
+        if var == "ckd_stage_claims":
+            query.where("ckd_no_esrd_flag = ?", 1)
+        df_all = pd.concat([df_all, util.read_query(query, ctx)])
     return df_all
 
 
+@instrumentation.instrument
+def save_member_results(input_args, prev_year, ctx):
+    """
+    Saves member-level flags, stages, enrolled months and (with diagnostics) costs
+        for later comparisons
+    Returns nothing (but writes a parquet file and member dimension arrays)
+    """
+    cost_select = np.where(
+        input_args["diagnostics"],
+        "c.cost_sum, c.n_year",
+        "null as cost_sum, null as n_year",
+    )
+    cost_join = np.where(
+        input_args["diagnostics"],
+        "left join member_cost as c on f.member_id = c.member_id",
+        "",
+    )
+    df = pd.read_sql(
+        f"""
+        select f.member_id
+              ,f.age
+              ,f.jvhl_denom_flag
+              ,f.ckd_jvhl_flag
+              ,f.ckd_ccw_flag
+              ,f.ckd_ccw_lab_flag
+              ,f.ckd_no_esrd_flag
+              ,f.esrd_flag
+              ,f.aki_flag_{input_args['year']} as aki_flag
+              ,f.aki_flag_{prev_year} as aki_flag_prev
+              ,f.ckd_stage_jvhl_detailed
+              ,f.ckd_stage_claims
+              ,f.ckd_stage_comb_all
+              ,f.ckd_stage_comb_5andesrd
+              ,f.ckd_stage_comb_w3unsp
+              ,f.ckd_stage_comb_5cat
+              ,e.n_month
+              ,e.n_month_medical_nondual
+              ,e.n_month_dual
+              ,{cost_select}
+        from final_flags as f
+            left join (
+                select member_id
+                      ,count(*) as n_month
+                      ,count_if(medical_flag = 'Y' and dual_flag = 'N') as n_month_medical_nondual
+                      ,count_if(dual_flag = 'Y') as n_month_dual
+                from math_prod.common.enroll_{input_args['year']}
+                group by member_id
+                ) as e
+                on f.member_id = e.member_id
+            {cost_join}
+        order by f.member_id
+    """,
+        con=ctx,
+    )
+    df.columns = df.columns.str.lower()
+    path = member_dim.results_path(input_args["year"], input_args["test_name"])
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    df.to_parquet(path, index=False)
+    member_dim.build(df, member_dim.dim_path(input_args["year"], input_args["test_name"]))
+
+
+def run_job(input_args, cs, ctx):
+    """
+    Runs the full pipeline for one set of arguments on an open connection
+    Returns the path of the output file and the number of failed validation checks
+    """
+    prev_year = str(int(input_args["year"]) - 1)
+    path = output_path(input_args)
+    input_args["checks"] = []
+    if input_args["profile"]:
+        instrumentation.enable()
+    else:
+        instrumentation.disable()
+    if input_args["engine"] == "local":
+        source_cache.refresh([prev_year, input_args["year"]], ctx)
+
+    with open(path, "w") as f:
+        cond_flags(input_args, prev_year, cs, ctx, f)
+        stage_flags(input_args, prev_year, cs, ctx, f)
+
+        if input_args["diagnostics"]:
+            diagnostics(input_args, prev_year, cs, ctx, f)
+
+        failed = validation.write_summary(input_args["checks"], f)
+
+    if input_args["save_results"]:
+        save_member_results(input_args, prev_year, ctx)
+
+    if input_args["profile"]:
+        instrumentation.write_report(path)
+        instrumentation.disable()
+    return path, failed
+
+
 def main():
     input_args = process_arguments(sys.argv[1:])
-    output_date = np.where(input_args["test_run"], "", "_{}".format(str(date.today())))
-
-    f = open(
-        f"output/{input_args['test_name']}ckd_lab_claims_diagnostics_{input_args['year']}{output_date}.txt",
-        "w",
-    )
 
     config = util.import_credentials()
     ctx, cs = util.snowflake_con(config, role="SYSADMIN")
 
-    prev_year = str(int(input_args["year"]) - 1)
-    cond_flags(input_args, prev_year, cs, ctx, f)
-    stage_flags(input_args, prev_year, cs, ctx, f)
-
-    if input_args["diagnostics"]:
-        diagnostics(input_args, prev_year, cs, ctx, f)
+    path, failed = run_job(input_args, cs, ctx)
 
     util.close_con(ctx, cs)
-    f.close()
+    if failed > 0:
+        sys.exit(1)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,170 @@
+import pandas as pd
+import numpy as np
+import sys
+import argparse
+import utilities as util
+import member_dim
+
+NOT_ENROLLED = "Not enrolled"
+
+
+def process_arguments(args):
+    """
+    Processes command line arguments provided to ckd_stage_transitions.py
+    Returns a dictionary of arguments
+    """
+    parser = argparse.ArgumentParser(
+        description="Year-over-year CKD stage transitions from saved member-level results"
+    )
+    parser.add_argument(
+        "-yr",
+        "--years",
+        dest="years",
+        nargs="+",
+        required=True,
+        action="store",
+        help="Two or more years with saved results (formatted yyyy)",
+    )
+    parser.add_argument(
+        "-v",
+        "--vars",
+        dest="stage_vars",
+        nargs="+",
+        action="store",
+        choices=member_dim.STAGE_VARS,
+        default=["ckd_stage_comb_5cat", "ckd_stage_comb_5andesrd"],
+        help="Stage variables to compare across years",
+    )
+    parser.add_argument(
+        "-t",
+        "--test",
+        dest="test_run",
+        action="store_true",
+        help="Include this argument to compare results saved from test runs",
+    )
+    parser.add_argument(
+        "-o",
+        "--output",
+        dest="output_path",
+        action="store",
+        default="",
+        help="Path of the output file (defaults to the output folder)",
+    )
+
+    try:
+        assert len(args) > 0
+    except:
+        parser.print_help()
+        sys.exit(2)
+
+    inputs = vars(parser.parse_args(args))
+    try:
+        assert len(inputs["years"]) >= 2
+    except:
+        raise ValueError("At least two years are needed for transitions")
+    inputs["years"] = sorted(inputs["years"])
+    inputs["test_name"] = np.where(inputs["test_run"], "test_", "")
+    return inputs
+
+
+def align_members(ids_a, ids_b):
+    """
+    Merges two sorted member id arrays into their union
+    Returns the union and the positions of each year's members in it
+    """
+    members = np.union1d(ids_a, ids_b)
+    return members, np.searchsorted(members, ids_a), np.searchsorted(members, ids_b)
+
+
+def spread(values, positions, n, fill):
+    """
+    Places one year's member values at their positions in the merged member array
+    Returns an array
+    """
+    out = np.full(n, fill, dtype=values.dtype)
+    out[positions] = values
+    return out
+
+
+def transition_table(dim_a, dim_b, var, year_a, year_b):
+    """
+    Counts members (and sums costs, when both years saved them) for each stage-to-stage
+        transition between two years
+    Returns a dataframe
+    """
+    members, pos_a, pos_b = align_members(dim_a.member_id, dim_b.member_id)
+    n = len(members)
+    categories = np.union1d(
+        dim_a.categories[var], dim_b.categories[var] + [NOT_ENROLLED]
+    )
+    not_enrolled = np.searchsorted(categories, NOT_ENROLLED)
+    codes = []
+    for dim, pos in [(dim_a, pos_a), (dim_b, pos_b)]:
+        # translate the year's own stage codes into codes over both years' categories
+        remap = np.searchsorted(categories, dim.categories[var])
+        codes.append(spread(remap[dim.stages[var]], pos, n, not_enrolled))
+    cell = codes[0] * len(categories) + codes[1]
+    n_cells = len(categories) ** 2
+
+    out = {
+        "from_stage": np.repeat(categories, len(categories)),
+        "to_stage": np.tile(categories, len(categories)),
+        "n": np.bincount(cell, minlength=n_cells),
+    }
+    df = pd.DataFrame(out)
+    if not (member_dim.has_costs(dim_a) and member_dim.has_costs(dim_b)):
+        print(f"Costs were not saved for both {year_a} and {year_b} (run with -d and -s); "
+              "reporting counts only")
+        return df[df["n"] > 0].reset_index(drop=True)
+
+    for year, dim, pos in [(year_a, dim_a, pos_a), (year_b, dim_b, pos_b)]:
+        for col in ["cost_sum", "n_year"]:
+            values = spread(np.nan_to_num(dim.attributes[col].astype(float)), pos, n, 0.0)
+            df[f"{col}_{year}"] = np.bincount(cell, weights=values, minlength=n_cells)
+    df = df[df["n"] > 0].reset_index(drop=True)
+    for year in [year_a, year_b]:
+        df[f"cost_per_bene_yr_{year}"] = df[f"cost_sum_{year}"] / df[f"n_year_{year}"].where(
+            df[f"n_year_{year}"] > 0
+        )
+    df["cost_delta"] = df[f"cost_sum_{year_b}"] - df[f"cost_sum_{year_a}"]
+    df["cost_per_bene_yr_delta"] = (
+        df[f"cost_per_bene_yr_{year_b}"] - df[f"cost_per_bene_yr_{year_a}"]
+    )
+    return df
+
+
+def transition_matrix(df):
+    """
+    Pivots transition counts into a from-stage by to-stage matrix
+    Returns a dataframe
+    """
+    return (
+        df.pivot(index="from_stage", columns="to_stage", values="n")
+        .fillna(0)
+        .astype(int)
+        .reset_index()
+    )
+
+
+def main():
+    input_args = process_arguments(sys.argv[1:])
+    years = input_args["years"]
+    output_path = input_args["output_path"]
+    if output_path == "":
+        output_path = f"output/{input_args['test_name']}ckd_stage_transitions_{years[0]}_{years[-1]}.txt"
+
+    results = {year: member_dim.load(year, input_args["test_name"]) for year in years}
+    with open(output_path, "w") as f:
+        for year_a, year_b in zip(years[:-1], years[1:]):
+            for var in input_args["stage_vars"]:
+                df = transition_table(results[year_a], results[year_b], var, year_a, year_b)
+                util.write_out_table(
+                    transition_matrix(df), f"{var} transitions from {year_a} to {year_b}", f
+                )
+                util.write_out_table(
+                    df, f"{var} transition counts and costs from {year_a} to {year_b}", f
+                )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,167 @@
+import sys
+import json
+import argparse
+import socketserver
+from snowflake.connector.errors import DatabaseError
+import utilities as util
+import ckd_stage_lab_claims as ckd
+
+# snowflake errors raised once a session or its token has expired
+EXPIRED_SESSION_ERRNOS = (390112, 390114)
+
+
+def process_arguments(args):
+    """
+    Processes command line arguments provided to the worker
+    Returns a dictionary of arguments
+    """
+    parser = argparse.ArgumentParser(
+        description="Runs the CKD stage pipeline as a long-running worker"
+    )
+    parser.add_argument(
+        "--host",
+        dest="host",
+        action="store",
+        default="127.0.0.1",
+        help="Address the worker listens on (defaults to localhost)",
+    )
+    parser.add_argument(
+        "-p",
+        "--port",
+        dest="port",
+        type=int,
+        action="store",
+        default=8765,
+        help="Port the worker listens on",
+    )
+    parser.add_argument(
+        "-r",
+        "--role",
+        dest="role",
+        action="store",
+        default="SYSADMIN",
+        help="Snowflake role used for the warm connection",
+    )
+    return vars(parser.parse_args(args))
+
+
+def open_session(config, role):
+    """
+    Opens a warm snowflake connection shared by all jobs
+    Returns a dictionary holding the connection and cursor
+    """
+    ctx, cs = util.snowflake_con(config, role=role, keep_alive=True)
+    return {"config": config, "role": role, "ctx": ctx, "cs": cs}
+
+
+def reconnect(session):
+    """
+    Replaces the session's connection with a new one
+    Returns nothing (but refreshes the session in place)
+    """
+    try:
+        util.close_con(session["ctx"], session["cs"])
+    except DatabaseError:
+        pass
+    session["ctx"], session["cs"] = util.snowflake_con(
+        session["config"], role=session["role"], keep_alive=True
+    )
+
+
+def warm_connection(session):
+    """
+    Reconnects the session if the warehouse closed the connection
+    Returns nothing (but refreshes the session in place)
+    """
+    if session["ctx"].is_closed():
+        reconnect(session)
+
+
+def job_arguments(job):
+    """
+    Converts a job request into the pipeline's command line arguments
+    Returns a list of strings
+    """
+    args = ["-yr", str(job["year"])]
+    if job.get("test", False):
+        args.append("-t")
+    if job.get("diag", False):
+        args.append("-d")
+    if job.get("profile", False):
+        args.append("-p")
+    if job.get("save", False):
+        args.append("-s")
+    if job.get("engine", "") != "":
+        args += ["-e", job["engine"]]
+    if job.get("output", "") != "":
+        args += ["-o", job["output"]]
+    return args
+
+
+def run_request(job, session):
+    """
+    Runs one job request on the warm session, reconnecting and retrying once if the
+        session has expired
+    Returns a dictionary describing the outcome
+    """
+    try:
+        input_args = ckd.process_arguments(job_arguments(job))
+    except SystemExit:
+        return {"status": "error", "message": "invalid job arguments"}
+    except Exception as e:
+        return {"status": "error", "message": str(e)}
+
+    for attempt in range(2):
+        try:
+            warm_connection(session)
+            path, failed = ckd.run_job(input_args, session["cs"], session["ctx"])
+        except DatabaseError as e:
+            if attempt == 0 and e.errno in EXPIRED_SESSION_ERRNOS:
+                reconnect(session)
+                continue
+            return {"status": "error", "message": str(e)}
+        except Exception as e:
+            return {"status": "error", "message": str(e)}
+        return {"status": "ok", "output": path, "failed_checks": failed}
+
+
+class JobHandler(socketserver.StreamRequestHandler):
+    """
+    Reads newline-delimited JSON job requests and replies with one JSON line each
+    """
+
+    def handle(self):
+        for line in self.rfile:
+            if line.strip() == b"":
+                continue
+            try:
+                job = json.loads(line)
+            except ValueError:
+                response = {"status": "error", "message": "request is not valid JSON"}
+            else:
+                response = run_request(job, self.server.session)
+            self.wfile.write((json.dumps(response) + "\n").encode())
+
+
+def main():
+    worker_args = process_arguments(sys.argv[1:])
+
+    config = util.import_credentials()
+    session = open_session(config, worker_args["role"])
+
+    # jobs share the session's temp tables, so they are served one at a time
+    with socketserver.TCPServer(
+        (worker_args["host"], worker_args["port"]), JobHandler
+    ) as server:
+        server.session = session
+        print(f"Listening for jobs on {worker_args['host']}:{worker_args['port']}")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+
+    util.close_con(session["ctx"], session["cs"])
+
+
+if __name__ == "__main__":
+    main()
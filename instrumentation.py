@@ -0,0 +1,207 @@
+import os
+import sys
+import time
+import functools
+import tracemalloc
+import pandas as pd
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+try:
+    import psutil
+except ImportError:  # optional; only needed for peak memory on Windows
+    psutil = None
+
+# instrumentation is opt-in; steps run untouched until enable() is called
+_state = {"enabled": False, "records": [], "stack": []}
+
+
+def enable():
+    """
+    Turns on step instrumentation and clears earlier records
+    Returns nothing
+    """
+    _state["enabled"] = True
+    _state["records"] = []
+    _state["stack"] = []
+    if not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+
+def disable():
+    """
+    Turns off step instrumentation
+    Returns nothing
+    """
+    _state["enabled"] = False
+    if tracemalloc.is_tracing():
+        tracemalloc.stop()
+
+
+def max_rss_mb():
+    """
+    Finds the peak resident memory of the process so far
+    Returns a number of megabytes (or None where unsupported)
+    """
+    if resource is not None:
+        # ru_maxrss is in bytes on macOS and kilobytes elsewhere
+        unit = 2**20 if sys.platform == "darwin" else 2**10
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / unit
+    # without resource (Windows), psutil reports the peak working set in bytes
+    peak_wset = getattr(psutil.Process().memory_info(), "peak_wset", None) if psutil else None
+    if peak_wset is None:
+        return None
+    return peak_wset / 2**20
+
+
+def frame_size(obj):
+    """
+    Measures a dataframe's shape and memory
+    Returns a tuple of rows, columns and megabytes (or Nones for other objects)
+    """
+    if not isinstance(obj, pd.DataFrame):
+        return None, None, None
+    return len(obj), obj.shape[1], obj.memory_usage(deep=True).sum() / 2**20
+
+
+def take_snapshot():
+    """
+    Takes a snapshot of traced allocations, leaving out tracemalloc's own
+    Returns a snapshot
+    """
+    return tracemalloc.take_snapshot().filter_traces(
+        [tracemalloc.Filter(False, tracemalloc.__file__)]
+    )
+
+
+class step:
+    """
+    Context manager recording wall time, CPU time, peak traced memory and the largest
+        new allocations of a block of code
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.frame = None
+
+    def __enter__(self):
+        if not _state["enabled"]:
+            return self
+        current, peak = tracemalloc.get_traced_memory()
+        # hand the peak so far to the enclosing step before resetting it for this one
+        if len(_state["stack"]) > 0:
+            parent = _state["stack"][-1]
+            parent["peak"] = max(parent["peak"], peak)
+        tracemalloc.reset_peak()
+        self.frame = {
+            "start_memory": current,
+            "peak": current,
+            "snapshot": take_snapshot(),
+            "wall": time.perf_counter(),
+            "cpu": time.process_time(),
+        }
+        _state["stack"].append(self.frame)
+        return self
+
+    def record(self, obj):
+        """
+        Attaches the size of a dataframe produced or consumed by the step
+        Returns nothing
+        """
+        if self.frame is not None:
+            self.frame["size"] = frame_size(obj)
+
+    def __exit__(self, exc_type, exc, tb):
+        if self.frame is None:
+            return False
+        frame = _state["stack"].pop()
+        wall = time.perf_counter() - frame["wall"]
+        cpu = time.process_time() - frame["cpu"]
+        peak = max(frame["peak"], tracemalloc.get_traced_memory()[1])
+        stats = take_snapshot().compare_to(frame["snapshot"], "lineno")
+        largest = [
+            f"{os.path.basename(s.traceback[0].filename)}:{s.traceback[0].lineno} "
+            f"({s.size_diff / 2**20:.1f} MB)"
+            for s in stats[:3]
+            if s.size_diff > 0
+        ]
+        rows, cols, mb = frame.get("size", (None, None, None))
+        _state["records"].append(
+            {
+                "step": self.name,
+                "depth": len(_state["stack"]),
+                "wall_s": wall,
+                "cpu_s": cpu,
+                "peak_mb": (peak - frame["start_memory"]) / 2**20,
+                "max_rss_mb": max_rss_mb(),
+                "df_rows": rows,
+                "df_cols": cols,
+                "df_mb": mb,
+                "largest_allocations": "; ".join(largest),
+            }
+        )
+        if len(_state["stack"]) > 0:
+            parent = _state["stack"][-1]
+            parent["peak"] = max(parent["peak"], peak)
+        tracemalloc.reset_peak()
+        return False
+
+
+def instrument(func):
+    """
+    Decorates a pipeline function so each call is recorded as a step when enabled,
+        along with the size of the dataframe it returns (or its first dataframe argument)
+    """
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if not _state["enabled"]:
+            return func(*args, **kwargs)
+        with step(func.__name__) as s:
+            result = func(*args, **kwargs)
+            frames = [result] + list(args) + list(kwargs.values())
+            s.record(next((x for x in frames if isinstance(x, pd.DataFrame)), None))
+        return result
+
+    return wrapper
+
+
+def report():
+    """
+    Collects the recorded steps, with totals per step name
+    Returns two dataframes (calls and totals)
+    """
+    calls = pd.DataFrame(_state["records"])
+    if len(calls) == 0:
+        return calls, calls
+    totals = (
+        calls.groupby("step", sort=False)
+        .agg(
+            calls=("step", "size"),
+            wall_s=("wall_s", "sum"),
+            cpu_s=("cpu_s", "sum"),
+            peak_mb=("peak_mb", "max"),
+            max_rss_mb=("max_rss_mb", "max"),
+            df_mb=("df_mb", "max"),
+        )
+        .reset_index()
+        .sort_values("peak_mb", ascending=False)
+    )
+    return calls, totals
+
+
+def write_report(path):
+    """
+    Writes the step report next to the output file
+    Returns the path of the report
+    """
+    calls, totals = report()
+    report_path = os.path.splitext(path)[0] + "_profile.txt"
+    with open(report_path, "w") as f:
+        for df, title in [(totals, "Totals by step"), (calls, "Step calls in order of completion")]:
+            f.write("{}\n".format(title))
+            f.write(df.to_string(header=True, index=False, float_format="{:.3f}".format) + "\n\n")
+    return report_path
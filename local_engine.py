@@ -0,0 +1,90 @@
+import pandas as pd
+
+
+def freq(df, vars):
+    """
+    Gets a frequency of a local dataframe in the same layout as freq_query
+    Returns a dataframe
+    """
+    return (
+        df.groupby(vars, dropna=False)
+        .size()
+        .reset_index(name="n")
+        .sort_values(vars)
+        .reset_index(drop=True)
+    )
+
+
+def lab_flags(jvhl):
+    """
+    Flags members with two low eGFR labs at least 90 days apart
+    Returns a member-level dataframe matching the jvhl_flags table
+    """
+    low = jvhl[jvhl["numericresult"] < 60]
+    dates = low.groupby("member_id")["date_servicebegin"].agg(["min", "max"])
+    days = (dates["max"].dt.normalize() - dates["min"].dt.normalize()).dt.days
+    return pd.DataFrame(
+        {"member_id": dates.index, "ckd_jvhl_flag_2labs": (days >= 90).astype(int).values}
+    )
+
+
+def lab_stage(jvhl):
+    """
+    Takes the lowest result from each member's most recent lab day
+    Returns a member-level dataframe matching the jvhl_maxdate_result table
+    """
+    max_date = (
+        jvhl[jvhl["all_results"].notna()]
+        .groupby("member_id")["date_servicebegin"]
+        .max()
+        .rename("max_date")
+    )
+    latest = jvhl.join(max_date, on="member_id", how="inner")
+    latest = latest[latest["date_servicebegin"] == latest["max_date"]]
+    return (
+        latest.groupby(["member_id", "date_servicebegin"])["all_results"]
+        .agg(all_results="min", n_labs="nunique")
+        .reset_index()
+    )
+
+
+def latest_dx(dx_date):
+    """
+    Takes the highest diagnosis from each member's most recent claim day
+    Returns a member-level dataframe of member_id, dx_num and from_date
+    """
+    max_date = dx_date.groupby("member_id")["from_date"].max().rename("max_date")
+    latest = dx_date.join(max_date, on="member_id", how="inner")
+    latest = latest[latest["from_date"] == latest["max_date"]]
+    return (
+        latest.groupby(["member_id", "from_date"])["dx_num"]
+        .max()
+        .reset_index()[["member_id", "dx_num", "from_date"]]
+    )
+
+
+def claims_stage(dx_date):
+    """
+    Assigns the most recent (or highest) claims stage, preferring a specific stage 3
+        over an unspecified one
+    Returns two member-level dataframes matching dx_maxdate_result and dx_date_result
+    """
+    dx_maxdate_result = latest_dx(dx_date)
+
+    unspecified = dx_maxdate_result[dx_maxdate_result["dx_num"] == 1830]
+    specific = dx_date[
+        dx_date["member_id"].isin(unspecified["member_id"])
+        & dx_date["dx_num"].isin([1831, 1832])
+    ]
+    stage3_maxdate_result = latest_dx(specific)
+
+    stage3_all = unspecified.set_index("member_id")
+    stage3_all.update(stage3_maxdate_result.set_index("member_id"))
+    dx_date_result = pd.concat(
+        [
+            stage3_all.reset_index(),
+            dx_maxdate_result[dx_maxdate_result["dx_num"] != 1830],
+        ],
+        ignore_index=True,
+    )
+    return dx_maxdate_result, dx_date_result
@@ -0,0 +1,139 @@
+import os
+import json
+import numpy as np
+import pandas as pd
+
+# per-member attributes and the compact type each is stored as; null values are -1 (or NaN)
+ATTRIBUTES = {
+    "age": np.int16,
+    "jvhl_denom_flag": np.int8,
+    "ckd_jvhl_flag": np.int8,
+    "ckd_ccw_flag": np.int8,
+    "ckd_ccw_lab_flag": np.int8,
+    "ckd_no_esrd_flag": np.int8,
+    "esrd_flag": np.int8,
+    "aki_flag": np.int8,
+    "aki_flag_prev": np.int8,
+    "n_month": np.int8,
+    "n_month_medical_nondual": np.int8,
+    "n_month_dual": np.int8,
+    "cost_sum": np.float64,
+    "n_year": np.float32,
+}
+
+STAGE_VARS = [
+    "ckd_stage_jvhl_detailed",
+    "ckd_stage_claims",
+    "ckd_stage_comb_all",
+    "ckd_stage_comb_5andesrd",
+    "ckd_stage_comb_w3unsp",
+    "ckd_stage_comb_5cat",
+]
+
+
+class MemberDim:
+    """
+    Sorted member ids for a year, with per-member attributes and stage codes held as
+        typed (memory-mapped) arrays in the same order
+    """
+
+    def __init__(self, member_id, attributes, stages, categories):
+        self.member_id = member_id
+        self.attributes = attributes
+        self.stages = stages
+        self.categories = categories
+
+    def __len__(self):
+        return len(self.member_id)
+
+
+def has_costs(dim):
+    """
+    Checks whether a year's results were saved with costs (diagnostics runs only)
+    Returns a boolean
+    """
+    return bool(np.isfinite(np.asarray(dim.attributes["n_year"], dtype=float)).any())
+
+
+def results_path(year, test_name="", directory="output/member_results"):
+    """
+    Defines the file holding saved member-level results for a year
+    Returns a string
+    """
+    return os.path.join(directory, f"{test_name}final_flags_{year}.parquet")
+
+
+def dim_path(year, test_name="", directory="output/member_results"):
+    """
+    Defines the folder holding the member dimension arrays for a year
+    Returns a string
+    """
+    return os.path.join(directory, f"{test_name}member_dim_{year}")
+
+
+def build(df, path):
+    """
+    Sorts member ids and writes each attribute and stage variable as a typed array
+    Returns a MemberDim
+    """
+    missing = [var for var in list(ATTRIBUTES) + STAGE_VARS if var not in df.columns]
+    if len(missing) > 0:
+        raise ValueError(
+            f"Saved results are missing {', '.join(missing)}; "
+            "re-run ckd_stage_lab_claims.py with -s for this year"
+        )
+    # sort as strings so the stored ids are in the order searchsorted and union1d expect
+    df = df.assign(member_id=df["member_id"].astype(str))
+    df = df.sort_values("member_id", ignore_index=True)
+    os.makedirs(path, exist_ok=True)
+    member_id = df["member_id"].to_numpy().astype(str)
+    np.save(os.path.join(path, "member_id.npy"), member_id)
+
+    for var, dtype in ATTRIBUTES.items():
+        if np.issubdtype(dtype, np.floating):
+            values = pd.to_numeric(df[var]).to_numpy(dtype=dtype, na_value=np.nan)
+        else:
+            values = pd.to_numeric(df[var]).fillna(-1).to_numpy(dtype=dtype)
+        np.save(os.path.join(path, f"{var}.npy"), values)
+
+    categories = {}
+    for var in STAGE_VARS:
+        labels = df[var].fillna("").astype(str).to_numpy()
+        categories[var], codes = np.unique(labels, return_inverse=True)
+        categories[var] = categories[var].tolist()
+        np.save(os.path.join(path, f"{var}.npy"), codes.astype(np.int8))
+    with open(os.path.join(path, "categories.json"), "w") as f:
+        json.dump(categories, f, indent=2)
+    return open_dim(path)
+
+
+def open_dim(path):
+    """
+    Opens saved member dimension arrays as memory maps
+    Returns a MemberDim
+    """
+    def array(name):
+        return np.load(os.path.join(path, f"{name}.npy"), mmap_mode="r")
+
+    with open(os.path.join(path, "categories.json")) as f:
+        categories = json.load(f)
+    return MemberDim(
+        array("member_id"),
+        {var: array(var) for var in ATTRIBUTES},
+        {var: array(var) for var in STAGE_VARS},
+        categories,
+    )
+
+
+def load(year, test_name=""):
+    """
+    Opens the member dimension for a year, building it from saved member-level
+        results if it has not been built yet
+    Returns a MemberDim
+    """
+    path = dim_path(year, test_name)
+    files = ["categories.json"] + [f"{var}.npy" for var in ATTRIBUTES]
+    # dimensions saved before an attribute was added are rebuilt
+    if all(os.path.exists(os.path.join(path, file)) for file in files):
+        return open_dim(path)
+    return build(pd.read_parquet(results_path(year, test_name)), path)
@@ -0,0 +1,88 @@
+class Query:
+    """
+    Builds a select statement with qmark bind parameters, so the warehouse can reuse
+        compiled plans and cached results across runs
+    """
+
+    def __init__(self, source, alias=""):
+        self.source = source
+        self.alias = alias
+        self.columns = []
+        self.joins = []
+        self.conditions = []
+        self.params = []
+        self.groups = []
+        self.orders = []
+        self.unions = []
+
+    def select(self, *columns):
+        self.columns += [str(c) for c in columns if c != ""]
+        return self
+
+    def join(self, source, alias, on, how="left"):
+        self.joins.append((how, source, alias, on))
+        return self
+
+    def where(self, condition, *params):
+        if condition != "":
+            self.conditions.append(str(condition))
+            self.params += list(params)
+        return self
+
+    def where_in(self, column, values):
+        if len(values) == 0:
+            raise ValueError(f"No values given to filter {column} on")
+        placeholders = ",".join(["?"] * len(values))
+        return self.where(f"{column} in ({placeholders})", *values)
+
+    def group_by(self, *columns):
+        self.groups += [c for c in columns if c != ""]
+        return self
+
+    def order_by(self, *columns):
+        self.orders += [c for c in columns if c != ""]
+        return self
+
+    def union_all(self, query):
+        self.unions.append(query)
+        return self
+
+    def sql(self):
+        """
+        Renders the statement
+        Returns the sql string and its list of bind parameters
+        """
+        params = []
+        source, source_params = render_source(self.source)
+        params += source_params
+        if self.alias != "":
+            source += f" as {self.alias}"
+
+        lines = ["select " + "\n    ,".join(self.columns or ["*"]), f"from {source}"]
+        for how, join_source, alias, on in self.joins:
+            join_sql, join_params = render_source(join_source)
+            lines.append(f"{how} join {join_sql} as {alias} on {on}")
+            params += join_params
+        if len(self.conditions) > 0:
+            lines.append("where " + "\n    and ".join(self.conditions))
+            params += self.params
+        if len(self.groups) > 0:
+            lines.append("group by " + ", ".join(self.groups))
+        for query in self.unions:
+            union_sql, union_params = query.sql()
+            lines += ["union all", union_sql]
+            params += union_params
+        if len(self.orders) > 0:
+            lines.append("order by " + ", ".join(self.orders))
+        return "\n".join(lines), params
+
+
+def render_source(source):
+    """
+    Renders a table name or a nested query for use in a from or join clause
+    Returns the sql string and its list of bind parameters
+    """
+    if isinstance(source, Query):
+        sql, params = source.sql()
+        return f"(\n{sql}\n)", params
+    return source, []
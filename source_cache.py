@@ -0,0 +1,193 @@
+import os
+import json
+from datetime import date, timedelta
+import pandas as pd
+import utilities as util
+from query_builder import Query
+
+CACHE_DIR = "cache"
+
+# rows this many days before a watermark are re-read on refresh to pick up late claims and labs
+LOOKBACK_DAYS = 180
+
+CKD_DX_CODES = ["N181", "N182", "N183", "N1830", "N1831", "N1832", "N184", "N185"]
+
+EGFR_LAB_CODE = "33914-3"
+
+LAB_COLUMNS = """member_id
+                  ,case when numericresult = 'NULL' then null
+                        else to_number(numericresult) end as numericresult
+                  ,textresult
+                  ,case when rlike(textresult, '>/?=? ?(60|90|120).?0?0?')
+                            then to_number(replace(replace(replace(textresult,'/',''),'=',''),'>',''))
+                        when numericresult != 'NULL' then to_number(numericresult)
+                        else null end as all_results
+                  ,DATE_SERVICEBEGIN"""
+
+DX_NUM = """case when len(a.dx_code) = 4 then to_number(concat(right(a.dx_code,3),'0'))
+                    when len(a.dx_code) = 5 then to_number(right(a.dx_code,4))
+                    else null end as dx_num"""
+
+EXTRACT_DATES = {"labs": "date_servicebegin", "dx": "from_date"}
+
+# id columns used as a second watermark; the lab source has no row or load id
+EXTRACT_IDS = {"dx": "claim_id"}
+
+
+def lab_query(years, since=""):
+    """
+    Builds the eGFR lab extract for the given years, optionally only rows after a date
+    Returns a query
+    """
+    query = (
+        Query("nkfm_prod.jvhl.labresults")
+        .select(LAB_COLUMNS)
+        .where("requestcpt = ?", EGFR_LAB_CODE)
+        .where_in("year(DATE_SERVICEBEGIN)", [int(year) for year in years])
+    )
+    if since != "":
+        query.where("DATE_SERVICEBEGIN > ?", since)
+    return query
+
+
+def dx_query(year, since="", since_id=""):
+    """
+    Builds the CKD diagnosis extract for one year, optionally only rows after a date
+        or with a claim id above the id watermark
+    Returns a query
+    """
+    # rows without a from_date never reach a member's most recent stage, so they are not kept
+    query = (
+        Query(f"math_prod.common.claims_dx_long_{year}", "a")
+        .select("a.member_id", "a.claim_id", "a.dx_code", "b.from_date", DX_NUM)
+        .join("nkfm_prod.mdhhs.nkfm_claims", "b", "a.claim_id = b.claim_id", how="inner")
+        .where_in("a.dx_code", CKD_DX_CODES)
+        .where("b.from_date is not null")
+    )
+    if since != "" and since_id != "":
+        query.where("(b.from_date > ? or a.claim_id > ?)", since, since_id)
+    elif since != "":
+        query.where("b.from_date > ?", since)
+    return query
+
+
+def extract_query(extract, year, since="", since_id=""):
+    """
+    Builds the filtered source extract for one year, optionally only rows after
+        the date (and id) watermarks
+    Returns a query
+    """
+    if extract == "labs":
+        return lab_query([year], since=since)
+    return dx_query(year, since=since, since_id=since_id)
+
+
+def partition_path(extract, year):
+    """
+    Defines the parquet file holding one year of an extract
+    Returns a string
+    """
+    return os.path.join(CACHE_DIR, extract, f"year={year}.parquet")
+
+
+def read_watermarks():
+    """
+    Reads the refresh watermarks of the local cache
+    Returns a dictionary of watermarks by extract and year
+    """
+    path = os.path.join(CACHE_DIR, "watermarks.json")
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def write_watermarks(watermarks):
+    """
+    Saves the refresh watermarks of the local cache
+    Returns nothing
+    """
+    with open(os.path.join(CACHE_DIR, "watermarks.json"), "w") as f:
+        json.dump(watermarks, f, indent=2)
+
+
+def is_closed(year):
+    """
+    Checks whether a year is old enough that its source rows no longer change
+    Returns a boolean
+    """
+    return int(year) < date.today().year - 1
+
+
+def refresh_partition(extract, year, watermarks, ctx):
+    """
+    Brings one year of an extract up to date, re-reading only rows near or after its
+        date watermark or above its id watermark; the refresh that closes a year
+        re-extracts it in full so nothing missed incrementally is frozen in
+    Returns nothing (but rewrites the parquet partition and updates the watermarks)
+    """
+    year_marks = watermarks.setdefault(extract, {})
+    mark = year_marks.get(year, {})
+    path = partition_path(extract, year)
+    date_var = EXTRACT_DATES[extract]
+    id_var = EXTRACT_IDS.get(extract, "")
+    if os.path.exists(path) and mark.get("closed", False):
+        return
+
+    full = (
+        not os.path.exists(path)
+        or mark.get("watermark", "") == ""
+        or is_closed(year)
+    )
+    if not full:
+        cached = pd.read_parquet(path)
+        # partitions written before the id watermark existed lack the id column
+        full = id_var != "" and id_var not in cached.columns
+    if full:
+        since, since_id = "", ""
+        cached = pd.DataFrame()
+    else:
+        since = str(date.fromisoformat(mark["watermark"]) - timedelta(days=LOOKBACK_DAYS))
+        since_id = mark.get("id_watermark", "")
+        cached = cached[cached[date_var] <= pd.Timestamp(since)]
+
+    fresh = util.read_query(extract_query(extract, year, since=since, since_id=since_id), ctx)
+    fresh.columns = fresh.columns.str.lower()
+    fresh[date_var] = pd.to_datetime(fresh[date_var])
+    df = pd.concat([cached, fresh], ignore_index=True)
+    if since_id != "":
+        # rows picked up by the id watermark can already be in the cached rows
+        df = df.drop_duplicates(ignore_index=True)
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    df.to_parquet(path, index=False)
+    year_marks[year] = {
+        "watermark": "" if len(df) == 0 else str(df[date_var].max().date()),
+        "id_watermark": "" if id_var == "" or len(df) == 0 else str(df[id_var].max()),
+        "refreshed": str(date.today()),
+        "closed": is_closed(year),
+    }
+
+
+def refresh(years, ctx):
+    """
+    Refreshes the lab and diagnosis extracts for each year in the local cache
+    Returns nothing
+    """
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    watermarks = read_watermarks()
+    for extract in EXTRACT_DATES:
+        for year in years:
+            refresh_partition(extract, str(year), watermarks, ctx)
+    write_watermarks(watermarks)
+
+
+def load_extract(extract, years):
+    """
+    Reads the cached partitions of an extract for the given years
+    Returns a dataframe
+    """
+    return pd.concat(
+        [pd.read_parquet(partition_path(extract, str(year))) for year in years],
+        ignore_index=True,
+    )
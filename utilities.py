@@ -1,8 +1,13 @@
 import pandas as pd
-import numpy as np
 import os
 import yaml
 import snowflake.connector
+from snowflake.connector.pandas_tools import write_pandas
+from query_builder import Query
+import instrumentation
+
+# bind parameters are sent to the server, so repeated statements reuse compiled plans
+snowflake.connector.paramstyle = "qmark"
 
 
 def import_credentials():
@@ -21,13 +26,16 @@ def import_credentials():
     return config
 
 
-def snowflake_con(config, role="NKFM_PROD"):
+def snowflake_con(config, role="NKFM_PROD", keep_alive=False):
     """
-    Uses credentials to connect to snowflake
+    Uses credentials to connect to snowflake (keep_alive stops an idle session expiring)
     Returns connection and cursor
     """
     ctx = snowflake.connector.connect(
-        user=config["user"], password=config["password"], account=config["account"]
+        user=config["user"],
+        password=config["password"],
+        account=config["account"],
+        client_session_keep_alive=keep_alive,
     )
     cs = ctx.cursor()
     cs.execute("USE ROLE {}".format(role))
@@ -46,6 +54,7 @@ def close_con(ctx, cs):
     ctx.close()
 
 
+@instrumentation.instrument
 def write_out_table(df, title, f):
     """
     Writes a table to the output file with a title
@@ -72,24 +81,60 @@ def upload_to_temp_table(table_name, value_list, vars, cs):
     )
 
 
+def upload_dataframe(table_name, df, ctx):
+    """
+    Uploads a dataframe to a temporary database table, replacing any existing one
+    Returns nothing
+    """
+    write_pandas(
+        ctx,
+        df,
+        table_name.upper(),
+        auto_create_table=True,
+        table_type="temp",
+        overwrite=True,
+        quote_identifiers=False,
+        use_logical_type=True,
+    )
+
+
+@instrumentation.instrument
+def read_query(query, ctx):
+    """
+    Runs a built query
+    Returns a dataframe
+    """
+    sql, params = query.sql()
+    return pd.read_sql(sql, con=ctx, params=params if len(params) > 0 else None)
+
+
+def create_temp_table(table_name, query, cs):
+    """
+    Creates (or replaces) a temporary database table from a built query
+    Returns nothing
+    """
+    sql, params = query.sql()
+    cs.execute(
+        f"create or replace temp table {table_name} as\n{sql}",
+        params if len(params) > 0 else None,
+    )
+
+
 def freq_query(var, table, ctx, count="count(*)", count_var="n", where="",
-    addtl_count="", var_select=""):
+    addtl_count="", var_select="", params=()):
     """
     Gets a frequency of a database table
     Returns a dataframe
     """
-    var_select = np.where(var_select == "", var, var_select)
-    where_command = def_where_command(where)
-    return pd.read_sql(
-        f"""select
-                    {var_select}, {count} as {count_var} {addtl_count}
-                    from {table}
-                    {where_command}
-                    group by {var}
-                    order by {var}
-                    """,
-        con=ctx,
+    var_select = var if var_select == "" else var_select
+    query = (
+        Query(table)
+        .select(f"{var_select}, {count} as {count_var} {addtl_count}")
+        .where(where, *params)
+        .group_by(var)
+        .order_by(var)
     )
+    return read_query(query, ctx)
 
 
 def distribution_query(var, table, ctx, group_by="", group_by_var=""):
@@ -118,45 +163,21 @@ def distribution_query(var, table, ctx, group_by="", group_by_var=""):
     )
 
 
-def count_total(table, ctx, count="count(*)", where=""):
+def count_total(table, ctx, count="count(*)", where="", params=()):
     """
     Finds count from table
     Returns a number
     """
-    where_command = def_where_command(where)
-    table = pd.read_sql(
-        f"""select
-                    {count} as n
-                    from {table}
-                    {where_command}
-                    """,
-        con=ctx,
-    )
-    return table.iloc[0, 0]
+    query = Query(table).select(f"{count} as n").where(where, *params)
+    return read_query(query, ctx).iloc[0, 0]
 
 
-def get_cat_list(var, table, ctx, where=""):
+def get_cat_list(var, table, ctx, where="", params=()):
     """
     Gets all unique values of a variable from a table
     Returns a list
     """
-    where_command = def_where_command(where)
-    df = pd.read_sql(
-        f"""select 
-                {var}
-                from {table}
-                {where_command}
-                group by {var}
-                order by {var}""",
-        con=ctx,
-    )
+    query = Query(table).select(var).where(where, *params).group_by(var).order_by(var)
+    df = read_query(query, ctx)
     upcase_var = var.upper()
     return df[upcase_var].tolist()
-
-
-def def_where_command(where):
-    """
-    Defines if where command is present
-    Returns a string
-    """
-    return np.where(where == "", "", f"where {where}")
@@ -0,0 +1,90 @@
+import pandas as pd
+import utilities as util
+from query_builder import Query
+
+
+def profile_table(table, ctx, unique=(), counts=None, row_counts=()):
+    """
+    Collects the row count, distinct counts and conditional counts of a table, and the
+        row counts of related tables, in a single aggregate query
+    Returns a dictionary of results keyed by lowercase column name
+    """
+    counts = {} if counts is None else counts
+    columns = ["count(*) as n_rows"]
+    columns += [f"count(distinct {var}) as distinct_{var}" for var in unique]
+    columns += [f"count_if({condition}) as {name}" for name, condition in counts.items()]
+    columns += [f"(select count(*) from {other}) as n_rows_{other}" for other in row_counts]
+    df = util.read_query(Query(table).select(*columns), ctx)
+    return {k.lower(): v for k, v in df.iloc[0].to_dict().items()}
+
+
+def table_row_count(table, ctx):
+    """
+    Reads a table's row count from warehouse metadata without scanning it
+    Returns a number
+    """
+    query = (
+        Query("information_schema.tables")
+        .select("row_count")
+        .where("table_schema = current_schema()")
+        .where("table_name = ?", table.upper())
+    )
+    return util.read_query(query, ctx).iloc[0, 0]
+
+
+def check(checks, table, name, observed, expected):
+    """
+    Records whether an observed value matches its expected value
+    Returns nothing (but appends to the list of checks)
+    """
+    checks.append(
+        {
+            "table": table,
+            "check": name,
+            "expected": expected,
+            "observed": observed,
+            "passed": bool(observed == expected),
+        }
+    )
+
+
+def check_profile(checks, table, profile, unique=()):
+    """
+    Records uniqueness checks from a table profile
+    Returns nothing (but appends to the list of checks)
+    """
+    for var in unique:
+        check(checks, table, f"{var} is unique", profile[f"distinct_{var}"], profile["n_rows"])
+
+
+def check_coverage(checks, table, var, freq, values):
+    """
+    Records whether a frequency table already queried for the output only holds
+        expected categories
+    Returns nothing (but appends to the list of checks)
+    """
+    freq = freq.rename(columns=str.lower)
+    uncovered = freq.loc[freq[var].notna() & ~freq[var].isin(values), "n"].sum()
+    check(checks, table, f"{var} has only expected categories", int(uncovered), 0)
+
+
+def summary(checks):
+    """
+    Collects recorded checks into a table
+    Returns a dataframe
+    """
+    return pd.DataFrame(checks, columns=["table", "check", "expected", "observed", "passed"])
+
+
+def write_summary(checks, f):
+    """
+    Writes the validation summary to the output file and prints any failures
+    Returns the number of failed checks
+    """
+    df = summary(checks)
+    util.write_out_table(df, "Validation summary", f)
+    failed = df[~df["passed"]]
+    if len(failed) > 0:
+        print("Validation checks failed:")
+        print(failed)
+    return len(failed)